@@ -4,17 +4,20 @@ Video Analysis Script for LaneTrax App Study
 Extracts frames and transcribes audio from YouTube review videos
 """
 
+import argparse
 import os
+import re
 import sys
-import cv2
-import whisper
-import numpy as np
+import shutil
+import torch
+from faster_whisper import WhisperModel
 from pathlib import Path
 import json
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
 import subprocess
 import imageio_ffmpeg
-import wave
 
 # Paths
 BASE_DIR = Path("D:/Projects/BowlerTrax")
@@ -43,151 +46,317 @@ VIDEOS = [
 ]
 
 
-def load_audio_from_wav(file_path: str, sr: int = 16000) -> np.ndarray:
-    """Load audio from a WAV file as numpy array for Whisper"""
-    with wave.open(file_path, 'rb') as wav:
-        frames = wav.readframes(wav.getnframes())
-        audio = np.frombuffer(frames, dtype=np.int16).astype(np.float32) / 32768.0
-    return audio
-
-
-def extract_audio(video_path: Path, output_path: Path) -> Path:
-    """Extract audio from video to WAV file for Whisper"""
+def probe_video(video_path: Path):
+    """
+    Probe video fps, duration, and width with a single call, preferring
+    ffprobe but falling back to parsing `ffmpeg -i` stderr — imageio-ffmpeg
+    bundles only the ffmpeg binary, so ffprobe is often not on PATH.
+    """
+    ffprobe_exe = shutil.which("ffprobe")
+    if ffprobe_exe:
+        cmd = [
+            ffprobe_exe,
+            "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=avg_frame_rate,width:format=duration",
+            "-of", "json",
+            str(video_path)
+        ]
+
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            info = json.loads(result.stdout)
+            fps = None
+            duration = None
+            width = None
+            try:
+                num, den = info["streams"][0]["avg_frame_rate"].split("/")
+                if float(den) > 0:
+                    fps = float(num) / float(den)
+                width = int(info["streams"][0]["width"])
+                duration = float(info["format"]["duration"])
+            except (KeyError, IndexError, ValueError):
+                pass
+            return fps, duration, width
+
+    # ffmpeg invoked without an output prints the stream info on stderr
     ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
-    audio_file = output_path / f"{video_path.stem}.wav"
-
-    if audio_file.exists():
-        print(f"  Audio file already exists: {audio_file.name}")
-        return audio_file
-
-    print(f"  Extracting audio to: {audio_file.name}")
-    cmd = [
-        ffmpeg_exe,
-        "-i", str(video_path),
-        "-vn",  # No video
-        "-acodec", "pcm_s16le",  # PCM 16-bit
-        "-ar", "16000",  # 16kHz sample rate (Whisper expects this)
-        "-ac", "1",  # Mono
-        "-y",  # Overwrite
-        str(audio_file)
+    result = subprocess.run(
+        [ffmpeg_exe, "-hide_banner", "-i", str(video_path)],
+        capture_output=True, text=True
+    )
+
+    fps = None
+    duration = None
+    width = None
+    match = re.search(r"(\d+(?:\.\d+)?)\s*fps", result.stderr)
+    if match:
+        fps = float(match.group(1))
+    match = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = re.search(r"Video:.*?\s(\d{2,5})x(\d{2,5})", result.stderr)
+    if match:
+        width = int(match.group(1))
+
+    return fps, duration, width
+
+
+def _ffmpeg_supports_cuda(ffmpeg_exe: str) -> bool:
+    """Check whether ffmpeg was built with the NVDEC h264 decoder"""
+    try:
+        result = subprocess.run(
+            [ffmpeg_exe, "-hide_banner", "-decoders"],
+            capture_output=True, text=True
+        )
+    except OSError:
+        return False
+    return result.returncode == 0 and "h264_cuvid" in result.stdout
+
+
+def _build_ffmpeg_extract_cmd(ffmpeg_exe: str, video_path: Path, audio_file: Path,
+                              frames_dir: Path, fps_sample: float, cuda: bool,
+                              want_audio: bool = True, want_frames: bool = True,
+                              width=None) -> list:
+    """
+    Build a single ffmpeg command producing the 16kHz WAV and/or the sampled
+    JPEG sequence in one demux/decode pass. Video decodes/scales on GPU when
+    available. Outputs whose targets already exist can be dropped via the
+    want_* flags.
+    """
+    cmd = [ffmpeg_exe, "-y"]
+    if cuda:
+        cmd += [
+            "-hwaccel", "cuda",
+            "-hwaccel_output_format", "cuda",
+            "-c:v", "h264_cuvid",
+        ]
+    cmd += [
+        "-threads", "0",  # auto-size the decode thread pool (h264 slice threading)
+        "-i", str(video_path)
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"  ERROR extracting audio: {result.stderr}")
-        return None
+    if want_audio:
+        cmd += [
+            "-map", "0:a:0",
+            "-acodec", "pcm_s16le",  # PCM 16-bit
+            "-ar", "16000",  # 16kHz sample rate (Whisper expects this)
+            "-ac", "1",  # Mono
+            str(audio_file)
+        ]
+
+    if want_frames:
+        # Area-average scaling (flags=area / interp_algo=super) avoids the
+        # aliasing of the default bicubic when downscaling 1920 -> 1280.
+        # scale_npp has no min(1280,iw) guard, so only scale on GPU when the
+        # probed width says there is an actual downscale to do.
+        if cuda:
+            if width and width > 1280:
+                vf = f"fps={fps_sample},scale_npp=1280:-2:interp_algo=super,hwdownload,format=nv12"
+            elif width:
+                vf = f"fps={fps_sample},hwdownload,format=nv12"
+            else:
+                # Width unknown: download first and let the guarded CPU scaler decide
+                vf = f"fps={fps_sample},hwdownload,format=nv12,scale='min(1280,iw)':-2:flags=area"
+        else:
+            vf = f"fps={fps_sample},scale='min(1280,iw)':-2:flags=area"
+        cmd += [
+            "-map", "0:v:0",
+            "-vf", vf,
+            "-q:v", "4",  # ~quality 85
+            str(frames_dir / "frame_%04d.jpg")
+        ]
 
-    return audio_file
+    return cmd
 
 
-def extract_frames(video_path: Path, output_dir: Path, fps_sample: float = 0.5):
+def _build_frame_index(output_dir: Path, fps_sample: float, fps):
     """
-    Extract frames from video at specified sample rate
-    fps_sample: frames per second to extract (0.5 = 1 frame every 2 seconds)
+    Build and save the frame index from the files ffmpeg wrote. Timestamps
+    come from the sequence number ffmpeg put in each filename (frame_0001 is
+    t=0), so stale files from older runs with other naming schemes are
+    ignored and numeric order holds past frame 9999. Stream-written as
+    line-delimited JSON so the file never has to be serialized as one blob.
     """
-    print(f"\nExtracting frames from: {video_path.name}")
-
-    cap = cv2.VideoCapture(str(video_path))
-    if not cap.isOpened():
-        print(f"  ERROR: Could not open video")
-        return []
-
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    duration = total_frames / fps
-
-    print(f"  Video FPS: {fps:.2f}, Duration: {duration:.1f}s, Total frames: {total_frames}")
-
-    # Calculate frame interval
-    frame_interval = int(fps / fps_sample)
+    numbered = []
+    for filepath in output_dir.glob("frame_*.jpg"):
+        match = re.fullmatch(r"frame_(\d+)\.jpg", filepath.name)
+        if match:
+            numbered.append((int(match.group(1)), filepath.name))
+    numbered.sort()
 
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    frame_count = 0
-    saved_count = 0
     extracted_frames = []
+    index_file = output_dir / "frame_index.jsonl"
+    with open(index_file, "wb") as f:
+        for seq, filename in numbered:
+            timestamp = (seq - 1) / fps_sample
+            entry = {
+                "filename": filename,
+                "timestamp": timestamp,
+                "frame_number": int(round(timestamp * fps)) if fps else None
+            }
+            f.write(orjson.dumps(entry) + b"\n")
+            extracted_frames.append(entry)
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    return extracted_frames
 
-        if frame_count % frame_interval == 0:
-            timestamp = frame_count / fps
-            filename = f"frame_{saved_count:04d}_t{timestamp:.1f}s.jpg"
-            filepath = output_dir / filename
 
-            # Resize to reasonable size for analysis
-            height, width = frame.shape[:2]
-            if width > 1280:
-                scale = 1280 / width
-                frame = cv2.resize(frame, (int(width * scale), int(height * scale)))
+def _load_frame_index(index_file: Path):
+    """Read a line-delimited frame index back into a list"""
+    with open(index_file, "rb") as f:
+        return [orjson.loads(line) for line in f if line.strip()]
 
-            cv2.imwrite(str(filepath), frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            extracted_frames.append({
-                "filename": filename,
-                "timestamp": timestamp,
-                "frame_number": frame_count
-            })
-            saved_count += 1
 
-            if saved_count % 50 == 0:
-                print(f"  Extracted {saved_count} frames...")
+def extract_audio_and_frames(video_path: Path, audio_dir: Path, frames_dir: Path,
+                             fps_sample: float = 0.5, force: bool = False):
+    """
+    Extract the transcription WAV and sampled frames in one ffmpeg pass.
+    fps_sample: frames per second to extract (0.5 = 1 frame every 2 seconds)
 
-        frame_count += 1
+    One invocation with two output maps demuxes and reads the file once
+    instead of separate audio and frame passes. Returns (audio_file, frames)
+    where audio_file is None if audio extraction failed.
+    """
+    print(f"\nExtracting audio + frames from: {video_path.name}")
 
-    cap.release()
-    print(f"  Completed: {saved_count} frames extracted")
+    audio_file = audio_dir / f"{video_path.stem}.wav"
+    index_file = frames_dir / "frame_index.jsonl"
 
-    # Save frame index
-    index_file = output_dir / "frame_index.json"
-    with open(index_file, "w", encoding="utf-8") as f:
-        json.dump(extracted_frames, f, indent=2)
+    # Skip outputs whose targets already exist (unless --force)
+    want_audio = force or not audio_file.exists()
+    want_frames = force or not index_file.exists()
+    if not want_audio:
+        print(f"  Audio file already exists: {audio_file.name}")
+    if not want_frames:
+        print(f"  Frame index already exists: {index_file}")
+        frames = _load_frame_index(index_file)
+        if not want_audio:
+            return audio_file, frames
 
-    return extracted_frames
+    fps, duration, width = probe_video(video_path)
+    if fps and duration:
+        print(f"  Video FPS: {fps:.2f}, Duration: {duration:.1f}s")
+
+    frames_dir.mkdir(parents=True, exist_ok=True)
 
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    cuda = _ffmpeg_supports_cuda(ffmpeg_exe)
+    print(f"  Decode path: {'cuda (NVDEC)' if cuda else 'cpu'}")
+
+    cmd = _build_ffmpeg_extract_cmd(ffmpeg_exe, video_path, audio_file, frames_dir,
+                                    fps_sample, cuda, want_audio, want_frames, width)
+    # Discard stdout and keep stderr as raw bytes; it is only decoded on failure
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            bufsize=1024 * 1024)
+
+    if result.returncode != 0 and cuda:
+        # GPU decode can fail on unsupported profiles; retry on CPU
+        print(f"  CUDA decode failed, falling back to CPU")
+        cuda = False
+        cmd = _build_ffmpeg_extract_cmd(ffmpeg_exe, video_path, audio_file, frames_dir,
+                                        fps_sample, cuda,
+                                        want_audio=want_audio, want_frames=want_frames,
+                                        width=width)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                bufsize=1024 * 1024)
 
-def transcribe_audio(audio_path: Path, output_dir: Path, model_name: str = "base"):
+    if result.returncode != 0:
+        print(f"  ERROR extracting audio/frames: {result.stderr.decode('utf-8', errors='replace')}")
+        if want_audio and want_frames:
+            # A failed audio map (e.g. no audio stream) shouldn't cost us the
+            # frames the baseline's independent passes would have produced
+            print(f"  Retrying frame extraction without the audio output")
+            cmd = _build_ffmpeg_extract_cmd(ffmpeg_exe, video_path, audio_file, frames_dir,
+                                            fps_sample, cuda,
+                                            want_audio=False, want_frames=True,
+                                            width=width)
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    bufsize=1024 * 1024)
+            if result.returncode == 0:
+                frames = _build_frame_index(frames_dir, fps_sample, fps)
+                print(f"  Completed: {len(frames)} frames extracted (no audio)")
+                return None, frames
+        # Frames loaded from an existing index are still good
+        return (audio_file if audio_file.exists() else None), ([] if want_frames else frames)
+
+    if want_frames:
+        frames = _build_frame_index(frames_dir, fps_sample, fps)
+    print(f"  Completed: {len(frames)} frames extracted")
+
+    return (audio_file if audio_file.exists() else None), frames
+
+
+# Lazy Whisper model; only the transcriber thread in the main process loads
+# it, and it stays warm across all videos
+_MODEL = None
+
+
+def _get_model(model_name: str = "base") -> WhisperModel:
+    """Load the Whisper model once for the session (INT8 quantized via CTranslate2)"""
+    global _MODEL
+    if _MODEL is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        compute_type = "int8_float16" if device == "cuda" else "int8"
+        # Log the chosen device so a silent CPU fallback is obvious in the output
+        print(f"  Loading Whisper model '{model_name}' (device={device}, compute_type={compute_type})...")
+        _MODEL = WhisperModel(
+            model_name,
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=os.cpu_count()
+        )
+    return _MODEL
+
+
+def transcribe_audio(audio_path: Path, output_dir: Path, model: WhisperModel,
+                     force: bool = False):
     """
-    Transcribe audio file using Whisper
+    Transcribe audio file using faster-whisper (CTranslate2 backend)
     """
     print(f"\nTranscribing: {audio_path.name}")
 
-    # Load whisper model
-    print(f"  Loading Whisper model '{model_name}'...")
-    model = whisper.load_model(model_name)
-
-    # Load audio directly from WAV file
-    print(f"  Loading audio from WAV file...")
-    audio = load_audio_from_wav(str(audio_path))
+    # Reuse an existing transcript unless --force
+    json_file = output_dir / f"{audio_path.stem}_transcript.json"
+    if json_file.exists() and not force:
+        print(f"  Transcript already exists: {json_file.name}")
+        with open(json_file, "rb") as f:
+            return orjson.loads(f.read())
 
     print(f"  Transcribing audio (this may take a while)...")
-    result = model.transcribe(audio, verbose=False)
-
-    # Save full transcript as readable text
+    # faster-whisper decodes the WAV itself; segments is a lazy generator.
+    # The VAD filter drops silent stretches (intros, pauses) so the encoder
+    # only runs on speech.
+    segments, info = model.transcribe(
+        str(audio_path),
+        beam_size=5,
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=500)
+    )
+
+    # Iterate segments once, writing the readable transcript as we go
     transcript_file = output_dir / f"{audio_path.stem}_transcript.txt"
+    full_text = []
+    collected = []
     with open(transcript_file, "w", encoding="utf-8") as f:
         f.write(f"# Transcript: {audio_path.stem}\n\n")
-        for segment in result["segments"]:
-            start = str(timedelta(seconds=int(segment["start"])))
-            end = str(timedelta(seconds=int(segment["end"])))
-            text = segment["text"].strip()
+        for segment in segments:
+            start = str(timedelta(seconds=int(segment.start)))
+            end = str(timedelta(seconds=int(segment.end)))
+            text = segment.text.strip()
             f.write(f"[{start} - {end}] {text}\n")
+            full_text.append(segment.text)
+            collected.append({
+                "start": segment.start,
+                "end": segment.end,
+                "text": text
+            })
 
-    # Save JSON with segments for analysis
-    json_file = output_dir / f"{audio_path.stem}_transcript.json"
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump({
-            "text": result["text"],
-            "segments": [
-                {
-                    "start": seg["start"],
-                    "end": seg["end"],
-                    "text": seg["text"].strip()
-                }
-                for seg in result["segments"]
-            ]
-        }, f, indent=2)
+    result = {"text": "".join(full_text), "segments": collected}
+
+    # Save JSON with segments for analysis (orjson serializes straight to bytes)
+    with open(json_file, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
 
     print(f"  Saved transcript to: {transcript_file.name}")
     print(f"  Full text length: {len(result['text'])} characters")
@@ -196,58 +365,91 @@ def transcribe_audio(audio_path: Path, output_dir: Path, model_name: str = "base
     return result
 
 
-def main():
-    print("=" * 60)
-    print("LaneTrax Video Analysis - Frame Extraction & Transcription")
+def extract_one_video(video_info: dict, force: bool = False):
+    """Run the ffmpeg extraction stage for one video (pool worker)"""
+    print(f"\n{'='*60}")
+    print(f"Extracting: {video_info['title']}")
     print("=" * 60)
 
-    # Check ffmpeg
-    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
-    print(f"\nUsing ffmpeg from: {ffmpeg_exe}")
+    video_path = VIDEOS_DIR / video_info["file"]
+    video_name = video_info["name"]
+    frames_output = FRAMES_DIR / video_name
 
-    results = {}
-    TRANSCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
+    if not video_path.exists():
+        print(f"  ERROR: Video file not found: {video_path}")
+        return video_name, {
+            "title": video_info["title"],
+            "frames_extracted": 0,
+            "frames_dir": str(frames_output),
+            "error": "Video file not found"
+        }, None
 
-    for i, video_info in enumerate(VIDEOS, 1):
-        print(f"\n{'='*60}")
-        print(f"Processing Video {i}/3: {video_info['title']}")
-        print("=" * 60)
+    # Extract audio + frames in one ffmpeg pass (1 frame every 2 seconds)
+    audio_file, frames = extract_audio_and_frames(
+        video_path, TRANSCRIPTS_DIR, frames_output, fps_sample=0.5, force=force
+    )
 
-        video_path = VIDEOS_DIR / video_info["file"]
+    return video_name, {
+        "title": video_info["title"],
+        "frames_extracted": len(frames),
+        "frames_dir": str(frames_output)
+    }, (audio_file if audio_file and audio_file.exists() else None)
 
-        if not video_path.exists():
-            print(f"  ERROR: Video file not found: {video_path}")
-            continue
 
-        video_name = video_info["name"]
-        frames_output = FRAMES_DIR / video_name
+def _transcribe_job(audio_path: Path, output_dir: Path, force: bool = False):
+    """Transcription job for the dedicated transcriber thread (one warm model)"""
+    return transcribe_audio(audio_path, output_dir, _get_model(), force=force)
 
-        # Extract frames (1 frame every 2 seconds)
-        frames = extract_frames(video_path, frames_output, fps_sample=0.5)
 
-        # Extract audio first
-        audio_file = extract_audio(video_path, TRANSCRIPTS_DIR)
+def main():
+    parser = argparse.ArgumentParser(description="LaneTrax video frame extraction & transcription")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-extract and re-transcribe even when outputs already exist")
+    args = parser.parse_args()
 
-        if audio_file and audio_file.exists():
-            # Transcribe audio
-            transcript = transcribe_audio(audio_file, TRANSCRIPTS_DIR)
+    print("=" * 60)
+    print("LaneTrax Video Analysis - Frame Extraction & Transcription")
+    print("=" * 60)
 
-            results[video_name] = {
-                "title": video_info["title"],
-                "frames_extracted": len(frames),
-                "frames_dir": str(frames_output),
-                "transcript_length": len(transcript["text"]),
-                "segments_count": len(transcript["segments"])
-            }
-        else:
-            results[video_name] = {
-                "title": video_info["title"],
-                "frames_extracted": len(frames),
-                "frames_dir": str(frames_output),
-                "transcript_length": 0,
-                "segments_count": 0,
-                "error": "Audio extraction failed"
-            }
+    # Check ffmpeg
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    print(f"\nUsing ffmpeg from: {ffmpeg_exe}")
+
+    TRANSCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    # ffmpeg uses ~2 threads per video, so a few extraction workers saturate
+    # the box without thrashing. Transcription runs on one dedicated thread
+    # in this process that owns a single warm Whisper model, so video N+1's
+    # extraction overlaps video N's inference without reloading weights.
+    max_workers = max(1, min(len(VIDEOS), (os.cpu_count() or 2) // 2))
+    results = {}
+    transcript_futures = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as extract_pool, \
+            ThreadPoolExecutor(max_workers=1) as transcriber:
+        extract_futures = [
+            extract_pool.submit(extract_one_video, video_info, args.force)
+            for video_info in VIDEOS
+        ]
+
+        # Queue each transcription as soon as its audio is ready
+        for future in extract_futures:
+            video_name, data, audio_file = future.result()
+            results[video_name] = data
+            if audio_file:
+                transcript_futures[video_name] = transcriber.submit(
+                    _transcribe_job, audio_file, TRANSCRIPTS_DIR, args.force
+                )
+            elif "error" not in data:
+                data["error"] = "Audio extraction failed"
+
+        for video_name, future in transcript_futures.items():
+            transcript = future.result()
+            results[video_name]["transcript_length"] = len(transcript["text"])
+            results[video_name]["segments_count"] = len(transcript["segments"])
+
+    for data in results.values():
+        data.setdefault("transcript_length", 0)
+        data.setdefault("segments_count", 0)
 
     # Save summary
     summary_file = ANALYSIS_DIR / "analysis_summary.json"